@@ -1,13 +1,18 @@
 # app.py
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Literal
+from collections import OrderedDict
 import os
+import asyncio
 from dotenv import load_dotenv
-import requests
-import json
+import httpx
+import orjson
 import uvicorn
+from aiolimiter import AsyncLimiter
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,7 +20,8 @@ load_dotenv()
 # Define the FastAPI application
 app = FastAPI(
     title="Dog Product Recommender API",
-    description="An AI-powered service to provide personalized dog product recommendations using Groq LLMs."
+    description="An AI-powered service to provide personalized dog product recommendations using Groq LLMs.",
+    default_response_class=ORJSONResponse
 )
 
 # Mount the 'templates' directory to serve static files like index.html
@@ -29,11 +35,192 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 if not GROQ_API_KEY:
     raise ValueError("GROQ_API_KEY environment variable not set. Please create a .env file.")
 
-# Define the request body model for the recommendation endpoint
+# Shared async HTTP client for calls to the Groq API.
+# Reusing one client keeps connections alive between requests, and awaiting it
+# lets the event loop serve other requests while we wait on the LLM.
+# The auth headers are set once here instead of being rebuilt on every request.
+# HTTP/2 (needs the h2 package from httpx[http2]) multiplexes concurrent calls
+# over one TLS connection, so the pool only needs a modest number of sockets.
+HTTP_CLIENT = httpx.AsyncClient(
+    base_url="https://api.groq.com/openai/v1",
+    headers={
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {GROQ_API_KEY}"
+    },
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    # retries=2 retries failed connection attempts (not HTTP error responses)
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+        retries=2
+    )
+)
+
+# Number of requests sent on startup to open connections to Groq ahead of the first user
+WARM_UP_REQUESTS = 4
+
+@app.on_event("startup")
+async def warm_up_http_client():
+    """
+    Opens connections to the Groq API at startup, so the DNS lookup and TLS
+    handshake aren't paid by the first real request.
+    """
+    results = await asyncio.gather(
+        *(HTTP_CLIENT.head("/models") for _ in range(WARM_UP_REQUESTS)),
+        return_exceptions=True
+    )
+    # Only connection failures matter here; any HTTP status means the connection was opened
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        print(f"WARNING: Could not pre-connect to Groq API: {errors[0]}")
+
+@app.on_event("shutdown")
+async def close_http_client():
+    """
+    Closes the shared HTTP client when the application shuts down.
+    """
+    await HTTP_CLIENT.aclose()
+
+# Read the main HTML page once at startup so GET / doesn't hit the disk on every visit
+with open("templates/index.html", "rb") as f:
+    INDEX_HTML = f.read()
+
+# Prompt sent to the LLM for every recommendation, built once at import.
+# Only the dog's profile is filled in per request.
+PROMPT_TMPL = """
+You are a helpful AI assistant for a dog product company. Your goal is to provide a personalized product recommendation and a relevant insight based on the dog's profile.
+
+Dog Breed: {dog_breed}
+Dietary Preference: {diet_preference}
+Desired Product Type: {product_type}
+
+Please provide:
+1. A specific product recommendation.
+2. An insight related to cost-benefit or community behavior for this product/dog type.
+
+Format your response strictly as a JSON object with two keys: "recommendation" and "insight".
+Example:
+{{
+  "recommendation": "XYZ Brand Organic Chicken Dog Food",
+  "insight": "80% of Golden Retriever owners prefer large bags for cost savings."
+}}
+Ensure the recommendation is plausible for the given inputs and the insight is creative and relevant.
+"""
+
+# Prompt for the batch endpoint, which packs several dog profiles into one LLM call.
+# BATCH_PROFILE_TMPL is filled in once per profile and joined into {profiles}.
+BATCH_PROMPT_TMPL = """
+You are a helpful AI assistant for a dog product company. Your goal is to provide a personalized product recommendation and a relevant insight for each of the following {count} dog profiles.
+
+{profiles}
+For each profile, in the same order, please provide:
+1. A specific product recommendation.
+2. An insight related to cost-benefit or community behavior for this product/dog type.
+
+Format your response strictly as a JSON object with one key, "recommendations", whose value is an array of exactly {count} objects, one per profile, each with two keys: "recommendation" and "insight".
+Example:
+{{
+  "recommendations": [
+    {{
+      "recommendation": "XYZ Brand Organic Chicken Dog Food",
+      "insight": "80% of Golden Retriever owners prefer large bags for cost savings."
+    }}
+  ]
+}}
+Ensure each recommendation is plausible for its profile and each insight is creative and relevant.
+"""
+
+BATCH_PROFILE_TMPL = """Profile {index}:
+Dog Breed: {dog_breed}
+Dietary Preference: {diet_preference}
+Desired Product Type: {product_type}
+"""
+
+# Past this many profiles per prompt the output gets long and quality drops,
+# so larger batches are split into several Groq calls.
+MAX_PROFILES_PER_CALL = 20
+
+# Groq request bodies, serialized once at import with a placeholder for the prompt.
+# Each call only JSON-encodes the prompt and splices it in with build_payload().
+PROMPT_PLACEHOLDER = "__PROMPT__"
+PROMPT_PLACEHOLDER_JSON = orjson.dumps(PROMPT_PLACEHOLDER)
+
+CHAT_PAYLOAD_TMPL = orjson.dumps({
+    "model": "llama3-8b-8192", # Using an efficient open-source model available on Groq
+    "messages": [
+        {
+            "role": "user",
+            "content": PROMPT_PLACEHOLDER
+        }
+    ],
+    "response_format": { "type": "json_object" }, # Request JSON output
+    "temperature": 0.7 # Adjust creativity/randomness
+})
+
+STREAM_PAYLOAD_TMPL = orjson.dumps({
+    "model": "llama3-8b-8192",
+    "messages": [
+        {
+            "role": "user",
+            "content": PROMPT_PLACEHOLDER
+        }
+    ],
+    # Groq doesn't support JSON mode together with streaming, so here we rely on the prompt alone
+    "stream": True,
+    "temperature": 0.7
+})
+
+def build_payload(payload_tmpl: bytes, prompt: str) -> bytes:
+    """
+    Returns a serialized Groq request body with the prompt filled in.
+    """
+    return payload_tmpl.replace(PROMPT_PLACEHOLDER_JSON, orjson.dumps(prompt), 1)
+
+# Number of worker processes sharing the Groq rate limit below. Defaults to 1,
+# which is what `uvicorn app:app` runs. Running `python app.py` sets it to the
+# worker count it starts. If you start several workers another way (uvicorn
+# --workers, gunicorn -w), set WEB_CONCURRENCY to that number too.
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+
+# Groq's requests-per-minute allowance for this API key, enforced in-process so
+# bursts queue here instead of being rejected by Groq with a 429.
+# Each worker has its own limiter, so it gets an equal share of the total.
+GROQ_RPM_LIMIT = int(os.getenv("GROQ_RPM_LIMIT", 30))
+GROQ_RPM_PER_WORKER = GROQ_RPM_LIMIT / WORKERS
+if GROQ_RPM_PER_WORKER >= 1:
+    GROQ_RATE_LIMITER = AsyncLimiter(GROQ_RPM_PER_WORKER, time_period=60)
+else:
+    # Less than one request a minute per worker: allow one every 60 / share seconds,
+    # so the total across workers still stays within GROQ_RPM_LIMIT
+    GROQ_RATE_LIMITER = AsyncLimiter(1, time_period=60 / GROQ_RPM_PER_WORKER)
+
+# How long a request may wait for a rate limit slot before we answer 429 ourselves
+RATE_LIMIT_WAIT_SECONDS = 10
+RATE_LIMIT_POLL_SECONDS = 0.1
+
+# Cap on Groq calls in flight at once across all endpoints (per worker process).
+# Under a spike, extra requests wait briefly and then get a 503 instead of
+# piling up in the client pool and slowing every call down.
+GROQ_CONCURRENCY = asyncio.Semaphore(64)
+CONCURRENCY_WAIT_SECONDS = 2.0
+
+# Cap on concurrent Groq calls made by the batch endpoint, shared across requests.
+# Keep this well under the client's keep-alive pool so calls reuse connections.
+BATCH_CONCURRENCY = asyncio.Semaphore(32)
+
+# Define the request body model for the recommendation endpoint.
+# Whitespace is stripped and empty fields are rejected here, so FastAPI answers
+# bad input with a 422 before the handler runs.
 class RecommendationRequest(BaseModel):
-    dog_breed: str
-    diet_preference: str
-    product_type: str
+    model_config = ConfigDict(str_strip_whitespace=True, extra="ignore")
+
+    dog_breed: str = Field(min_length=1, max_length=128)
+    diet_preference: Literal["any", "vegetarian", "non-vegetarian"]
+    product_type: str = Field(min_length=1, max_length=128)
+
+# Define the request body model for the batch recommendation endpoint
+class BatchRecommendationRequest(BaseModel):
+    items: list[RecommendationRequest] = Field(min_length=1, max_length=100)
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root():
@@ -42,94 +229,534 @@ async def read_root():
     """
     # For a simple single HTML file in the templates directory, we serve it directly.
     # In a larger app, you might use FastAPI's jinja2 template engine.
-    with open("templates/index.html", "r") as f:
-        return f.read()
+    return HTMLResponse(content=INDEX_HTML)
+
+
+# In-memory LRU cache of recommendations keyed on (dog_breed, diet_preference, product_type).
+# Identical form submissions are answered from here instead of calling Groq again.
+RECOMMENDATION_CACHE_SIZE = 4096
+RECOMMENDATION_CACHE = OrderedDict()
+
+# Groq calls currently running, keyed like the cache, so identical requests
+# that arrive before the first one finishes wait on it instead of calling again.
+IN_FLIGHT_CALLS = {}
+
+# Streaming Groq calls currently running (a SharedLLMStream per key). Their tasks
+# are also in IN_FLIGHT_CALLS, so /get_recommendation waits on them too.
+IN_FLIGHT_STREAMS = {}
+
+def parse_llm_json(llm_content: str) -> dict:
+    """
+    Parses the JSON object in an LLM reply. If the LLM wrapped the object in
+    extra prose, the text from the first "{" to the last "}" is parsed instead.
+    Raises orjson.JSONDecodeError if no JSON object can be found.
+    """
+    try:
+        parsed = orjson.loads(llm_content)
+    except orjson.JSONDecodeError:
+        # A single find/rfind scan, instead of a regex that would have to match nested braces
+        start = llm_content.find("{")
+        end = llm_content.rfind("}")
+        if start == -1 or end < start:
+            raise
+        parsed = orjson.loads(llm_content[start:end + 1])
+
+    if not isinstance(parsed, dict):
+        raise orjson.JSONDecodeError("Expected a JSON object", llm_content, 0)
+    return parsed
+
+def is_retryable_groq_error(exc: BaseException) -> bool:
+    """
+    Returns True for Groq errors worth retrying: rate limiting (429), server
+    errors (5xx) and network failures.
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+async def acquire_groq_slot():
+    """
+    Takes one of the GROQ_CONCURRENCY slots, raising HTTPException(503) if none
+    frees up within CONCURRENCY_WAIT_SECONDS. The caller must release it.
+    """
+    try:
+        await asyncio.wait_for(GROQ_CONCURRENCY.acquire(), timeout=CONCURRENCY_WAIT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="The recommendation service is overloaded. Please try again shortly.")
+
+async def acquire_rate_limit():
+    """
+    Takes one request from GROQ_RATE_LIMITER, raising HTTPException(429) if no
+    capacity frees up within RATE_LIMIT_WAIT_SECONDS.
+    """
+    # aiolimiter leaves a stale entry in its waiter map when acquire() is cancelled,
+    # so instead of wrapping it in wait_for we poll for capacity until the deadline.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RATE_LIMIT_WAIT_SECONDS
+    while not GROQ_RATE_LIMITER.has_capacity():
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            # Fail fast rather than let the request hang until the client gives up
+            raise HTTPException(status_code=429, detail="The recommendation service is busy. Please try again shortly.")
+        await asyncio.sleep(min(RATE_LIMIT_POLL_SECONDS, remaining))
+
+    # There is capacity now, so acquire() returns without waiting
+    await GROQ_RATE_LIMITER.acquire()
+
+async def send_groq_request(payload: bytes, stream: bool = False) -> httpx.Response:
+    """
+    Sends a chat completion request to Groq, keeping under this worker's share
+    of GROQ_RPM_LIMIT and retrying 429s, 5xx responses and network errors with
+    exponential backoff.
+    Raises HTTPException(429) if no rate limit slot frees up in time, and the
+    last httpx.HTTPError if every attempt fails.
+    With stream=True the response body is left unread; the caller must close it.
+    """
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(4),
+        wait=wait_exponential_jitter(initial=0.5, max=5),
+        retry=retry_if_exception(is_retryable_groq_error),
+        reraise=True
+    ):
+        with attempt:
+            await acquire_rate_limit()
+
+            request = HTTP_CLIENT.build_request("POST", "/chat/completions", content=payload)
+            groq_response = await HTTP_CLIENT.send(request, stream=stream)
+            if groq_response.is_error:
+                await groq_response.aread()
+                await groq_response.aclose()
+                groq_response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
+    return groq_response
+
+async def request_llm_json(prompt: str) -> dict:
+    """
+    Sends a prompt to the Groq LLM in JSON mode and returns the parsed JSON object.
+    Raises httpx.HTTPError if the API call fails and orjson.JSONDecodeError if
+    the LLM doesn't return valid JSON.
+    """
+    # Make request to Groq API
+    await acquire_groq_slot()
+    try:
+        groq_response = await send_groq_request(build_payload(CHAT_PAYLOAD_TMPL, prompt))
+    finally:
+        GROQ_CONCURRENCY.release()
+
+    groq_data = orjson.loads(groq_response.content)
+
+    # Parse the content which is a JSON string
+    llm_content = groq_data['choices'][0]['message']['content']
+    try:
+        return parse_llm_json(llm_content)
+    except orjson.JSONDecodeError:
+        print(f"ERROR: LLM returned invalid JSON. Raw Content: {llm_content}")
+        raise
+
+async def open_llm_stream(prompt: str) -> httpx.Response:
+    """
+    Starts a streaming chat completion on the Groq API and returns the open response.
+    Raises httpx.HTTPError if the call fails. The caller must close the response.
+    """
+    return await send_groq_request(build_payload(STREAM_PAYLOAD_TMPL, prompt), stream=True)
+
+async def iter_llm_content(groq_response: httpx.Response):
+    """
+    Yields the text deltas from a streaming Groq response as they arrive.
+    Raises ValueError if Groq sends an error event or a chunk that isn't valid JSON.
+    """
+    async for line in groq_response.aiter_lines():
+        # Groq streams OpenAI-style server-sent events: "data: {...}" lines ending with "data: [DONE]"
+        if not line.startswith("data: "):
+            continue
+        data = line[len("data: "):]
+        if data == "[DONE]":
+            break
+        chunk = orjson.loads(data)
+        if 'error' in chunk:
+            raise ValueError(f"Groq stream error: {chunk['error']}")
+        choices = chunk.get('choices')
+        # Some chunks carry no choices at all, e.g. a final usage-only chunk
+        if not choices:
+            continue
+        delta = (choices[0].get('delta') or {}).get('content')
+        if delta:
+            yield delta
 
+async def call_groq(dog_breed: str, diet_preference: str, product_type: str) -> tuple[str, str]:
+    """
+    Asks the Groq LLM for a recommendation and insight for a single dog profile.
+    """
+    # Construct the prompt for the LLM
+    prompt = PROMPT_TMPL.format(
+        dog_breed=dog_breed,
+        diet_preference=diet_preference,
+        product_type=product_type
+    )
+    parsed_llm_content = await request_llm_json(prompt)
+
+    recommendation = parsed_llm_content.get('recommendation')
+    insight = parsed_llm_content.get('insight')
+
+    if not (recommendation and insight):
+        # Log the full LLM response if it doesn't contain expected keys
+        print(f"WARNING: LLM response missing expected keys. Content: {parsed_llm_content}") # Use print for simple logging
+        raise HTTPException(
+            status_code=500,
+            detail="Could not parse recommendation or insight from LLM response. LLM might have deviated from format."
+        )
+
+    return recommendation, insight
+
+async def call_groq_batch(profiles: list[tuple[str, str, str]]) -> list[tuple[str, str]]:
+    """
+    Asks the Groq LLM for recommendations for up to MAX_PROFILES_PER_CALL dog
+    profiles in a single call. Results are returned in the same order as the profiles.
+    """
+    prompt = BATCH_PROMPT_TMPL.format(
+        count=len(profiles),
+        profiles="\n".join(
+            BATCH_PROFILE_TMPL.format(
+                index=index,
+                dog_breed=dog_breed,
+                diet_preference=diet_preference,
+                product_type=product_type
+            )
+            for index, (dog_breed, diet_preference, product_type) in enumerate(profiles, start=1)
+        )
+    )
+    parsed_llm_content = await request_llm_json(prompt)
+
+    items = parsed_llm_content.get('recommendations')
+    if (
+        not isinstance(items, list)
+        or len(items) != len(profiles)
+        or not all(isinstance(item, dict) and item.get('recommendation') and item.get('insight') for item in items)
+    ):
+        print(f"WARNING: Batch LLM response doesn't match the {len(profiles)} requested profiles. Content: {parsed_llm_content}")
+        raise HTTPException(
+            status_code=500,
+            detail="Could not parse recommendations from LLM response. LLM might have deviated from format."
+        )
+
+    return [(item['recommendation'], item['insight']) for item in items]
+
+async def call_groq_batches(chunks: list[list[tuple[str, str, str]]]) -> list[list[tuple[str, str]]]:
+    """
+    Runs call_groq_batch for each chunk of profiles concurrently, at most
+    BATCH_CONCURRENCY at a time. If any call fails, the others are cancelled
+    and the first error is raised.
+    """
+    async def run_chunk(chunk):
+        async with BATCH_CONCURRENCY:
+            return await call_groq_batch(chunk)
+
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(run_chunk(chunk)) for chunk in chunks]
+    except ExceptionGroup as eg:
+        # Unwrap so the handler can map it to the usual HTTP error
+        raise eg.exceptions[0]
+
+    return [task.result() for task in tasks]
+
+def cache_recommendation(key: tuple[str, str, str], result: tuple[str, str]):
+    """
+    Stores a recommendation in the LRU cache, evicting the oldest entry if it's full.
+    """
+    RECOMMENDATION_CACHE[key] = result
+    if len(RECOMMENDATION_CACHE) > RECOMMENDATION_CACHE_SIZE:
+        RECOMMENDATION_CACHE.popitem(last=False)
+
+async def fetch_and_cache_recommendation(key: tuple[str, str, str]) -> tuple[str, str]:
+    """
+    Calls Groq for a dog profile and stores the result in the LRU cache.
+    """
+    result = await call_groq(*key)
+    cache_recommendation(key, result)
+    return result
+
+async def get_cached_recommendation(dog_breed: str, diet_preference: str, product_type: str) -> tuple[str, str]:
+    """
+    Returns the recommendation for a dog profile from the LRU cache, calling
+    Groq and caching the result on a miss. Failed calls are not cached.
+    Concurrent misses for the same profile share a single Groq call.
+    """
+    key = (dog_breed, diet_preference, product_type)
+    cached = RECOMMENDATION_CACHE.get(key)
+    if cached is not None:
+        RECOMMENDATION_CACHE.move_to_end(key)
+        return cached
+
+    # There's no await between the lookup and the insert, so this is safe without a lock
+    task = IN_FLIGHT_CALLS.get(key)
+    if task is None:
+        task = asyncio.create_task(fetch_and_cache_recommendation(key))
+        IN_FLIGHT_CALLS[key] = task
+        task.add_done_callback(lambda _: IN_FLIGHT_CALLS.pop(key, None))
 
-@app.post("/get_recommendation")
+    # Shield the shared call so one client disconnecting doesn't cancel it for the others
+    return await asyncio.shield(task)
+
+@app.post("/get_recommendation", response_model=None)
 async def get_recommendation(request_data: RecommendationRequest):
     """
     Handles the recommendation request by calling the Groq API.
     Receives dog details from the frontend and returns a personalized
     product recommendation and insight.
     """
-    # Initialize llm_content outside try block for error logging
-    llm_content = ""
     try:
-        dog_breed = request_data.dog_breed.strip()
-        diet_preference = request_data.diet_preference
-        product_type = request_data.product_type.strip()
-
-        # Input validation (FastAPI's BaseModel handles basic validation, but explicit checks are good)
-        if not dog_breed or not product_type:
-            raise HTTPException(status_code=400, detail="Dog breed and product type are required.")
-
-        # Construct the prompt for the LLM
-        prompt = f"""
-        You are a helpful AI assistant for a dog product company. Your goal is to provide a personalized product recommendation and a relevant insight based on the dog's profile.
-
-        Dog Breed: {dog_breed}
-        Dietary Preference: {diet_preference}
-        Desired Product Type: {product_type}
-
-        Please provide:
-        1. A specific product recommendation.
-        2. An insight related to cost-benefit or community behavior for this product/dog type.
-
-        Format your response strictly as a JSON object with two keys: "recommendation" and "insight".
-        Example:
-        {{
-          "recommendation": "XYZ Brand Organic Chicken Dog Food",
-          "insight": "80% of Golden Retriever owners prefer large bags for cost savings."
-        }}
-        Ensure the recommendation is plausible for the given inputs and the insight is creative and relevant.
-        """
+        recommendation, insight = await get_cached_recommendation(
+            request_data.dog_breed,
+            request_data.diet_preference,
+            request_data.product_type
+        )
+        # Returning the response directly skips FastAPI's jsonable_encoder pass
+        return ORJSONResponse({"recommendation": recommendation, "insight": insight})
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {GROQ_API_KEY}"
-        }
+    except HTTPException:
+        raise
+    except httpx.HTTPError as e:
+        print(f"ERROR: Error calling Groq API: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to connect to recommendation service: {e}")
+    except orjson.JSONDecodeError as e:
+        print(f"ERROR: Error parsing LLM JSON response: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to process LLM response. Invalid JSON from LLM: {e}")
+    except Exception as e:
+        print(f"ERROR: An unexpected error occurred: {e}")
+        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {e}")
 
-        payload = {
-            "model": "llama3-8b-8192", # Using an efficient open-source model available on Groq
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            "response_format": { "type": "json_object" }, # Request JSON output
-            "temperature": 0.7 # Adjust creativity/randomness
-        }
+def format_sse(data, event: str = None) -> bytes:
+    """
+    Encodes one server-sent event. The data is JSON-encoded so newlines in the
+    LLM's text can't end the event early.
+    """
+    message = b"data: " + orjson.dumps(data) + b"\n\n"
+    if event:
+        message = b"event: " + event.encode() + b"\n" + message
+    return message
+
+# Headers for server-sent event responses; stops proxies from buffering the stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+class SharedLLMStream:
+    """
+    One streaming Groq call for a dog profile that any number of clients can follow.
+    run() makes the call in its own task, so it finishes and fills the cache even if
+    the client that started it disconnects. follow() replays the text so far and
+    then yields new deltas as they arrive.
+    """
+
+    def __init__(self, key: tuple[str, str, str]):
+        self.key = key
+        self.parts = []
+        self.finished = False
+        # Set once the Groq stream is open or has failed to open (see open_error)
+        self.opened = asyncio.Event()
+        self.open_error = None
+        self._updated = asyncio.Event()
+
+    def _notify(self):
+        # Wake everyone waiting on the current event and start a fresh one for the next update
+        self._updated.set()
+        self._updated = asyncio.Event()
 
-        # Make request to Groq API
-        groq_response = requests.post("https://api.groq.com/openai/v1/chat/completions", headers=headers, json=payload)
-        groq_response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
+    async def run(self) -> tuple[str, str]:
+        """
+        Streams the LLM reply for self.key, then parses and caches it.
+        Raises HTTPException(503) if no concurrency slot is free, httpx.HTTPError
+        if the call fails, and ValueError if Groq sends a malformed chunk.
+        """
+        dog_breed, diet_preference, product_type = self.key
+        prompt = PROMPT_TMPL.format(
+            dog_breed=dog_breed,
+            diet_preference=diet_preference,
+            product_type=product_type
+        )
+
+        try:
+            # The slot is held until the stream is finished
+            await acquire_groq_slot()
+            try:
+                groq_response = await open_llm_stream(prompt)
+            except BaseException:
+                GROQ_CONCURRENCY.release()
+                raise
+        except BaseException as e:
+            if isinstance(e, httpx.HTTPError):
+                print(f"ERROR: Error calling Groq API: {e}")
+            self.open_error = e
+            self.finished = True
+            raise
+        finally:
+            self.opened.set()
 
-        groq_data = groq_response.json()
-        
-        # Parse the content which is a JSON string
-        llm_content = groq_data['choices'][0]['message']['content']
-        parsed_llm_content = json.loads(llm_content)
+        try:
+            try:
+                async for delta in iter_llm_content(groq_response):
+                    self.parts.append(delta)
+                    self._notify()
+            finally:
+                # Release in its own finally: a cancelled aclose() await mustn't skip it
+                try:
+                    await groq_response.aclose()
+                finally:
+                    GROQ_CONCURRENCY.release()
+        except httpx.HTTPError as e:
+            print(f"ERROR: Groq stream failed: {e}")
+            raise
+        except (ValueError, LookupError, TypeError, AttributeError) as e:
+            print(f"ERROR: Invalid chunk in Groq stream: {e}")
+            raise
+        finally:
+            self.finished = True
+            self._notify()
 
+        llm_content = "".join(self.parts)
+        try:
+            parsed_llm_content = parse_llm_json(llm_content)
+        except orjson.JSONDecodeError:
+            parsed_llm_content = {}
         recommendation = parsed_llm_content.get('recommendation')
         insight = parsed_llm_content.get('insight')
 
-        if recommendation and insight:
-            return {"recommendation": recommendation, "insight": insight}
+        if not (recommendation and insight):
+            # Streaming can't use Groq's JSON mode, so fall back to one JSON-mode call instead of failing
+            print(f"WARNING: Streamed LLM response missing expected keys, retrying in JSON mode. Content: {llm_content}")
+            recommendation, insight = await call_groq(*self.key)
+
+        # Cache the finished reply so later requests for this profile skip Groq
+        cache_recommendation(self.key, (recommendation, insight))
+        return recommendation, insight
+
+    async def follow(self):
+        """
+        Yields every text delta of the stream, starting from the first, until it finishes.
+        """
+        sent = 0
+        while True:
+            # Grab the event before yielding, so an update made meanwhile isn't missed
+            updated = self._updated
+            while sent < len(self.parts):
+                yield self.parts[sent]
+                sent += 1
+            if self.finished:
+                return
+            await updated.wait()
+
+def finish_stream_task(key: tuple[str, str, str], task: asyncio.Task):
+    """
+    Done callback for a SharedLLMStream task: drops it from the in-flight maps.
+    """
+    IN_FLIGHT_CALLS.pop(key, None)
+    IN_FLIGHT_STREAMS.pop(key, None)
+    # Mark the error as retrieved; it has been logged, and every client that
+    # was still connected has already received it
+    if not task.cancelled():
+        task.exception()
+
+@app.post("/stream_recommendation", response_model=None)
+async def stream_recommendation(request_data: RecommendationRequest):
+    """
+    Like /get_recommendation, but streams the reply to the client as
+    server-sent events while the LLM generates it.
+    Each text delta is sent as a plain event, followed by a "done" event with
+    the parsed recommendation and insight, or an "error" event.
+    Concurrent identical requests share one Groq call, like /get_recommendation.
+    """
+    key = (request_data.dog_breed, request_data.diet_preference, request_data.product_type)
+    cached = RECOMMENDATION_CACHE.get(key)
+    if cached is not None:
+        RECOMMENDATION_CACHE.move_to_end(key)
+        recommendation, insight = cached
+        return Response(
+            content=format_sse({"recommendation": recommendation, "insight": insight}, event="done"),
+            media_type="text/event-stream",
+            headers=SSE_HEADERS
+        )
+
+    # There's no await between the lookup and the insert, so this is safe without a lock.
+    # A call already started by /get_recommendation has no stream to follow; we just wait for its result.
+    task = IN_FLIGHT_CALLS.get(key)
+    shared_stream = IN_FLIGHT_STREAMS.get(key)
+    if task is None:
+        shared_stream = SharedLLMStream(key)
+        task = asyncio.create_task(shared_stream.run())
+        IN_FLIGHT_CALLS[key] = task
+        IN_FLIGHT_STREAMS[key] = shared_stream
+        task.add_done_callback(lambda done_task: finish_stream_task(key, done_task))
+
+    if shared_stream is not None:
+        # Report failures to start the call as HTTP errors, before any headers are sent
+        await shared_stream.opened.wait()
+        error = shared_stream.open_error
+        if isinstance(error, HTTPException):
+            raise error
+        if isinstance(error, httpx.HTTPError):
+            raise HTTPException(status_code=500, detail=f"Failed to connect to recommendation service: {error}")
+        if error is not None:
+            raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {error}")
+
+    async def relay():
+        if shared_stream is not None:
+            async for delta in shared_stream.follow():
+                yield format_sse(delta)
+
+        # The headers are already sent, so failures from here on become an error event, not a 500
+        try:
+            recommendation, insight = await asyncio.shield(task)
+        except HTTPException as e:
+            yield format_sse(e.detail, event="error")
+        except httpx.HTTPError as e:
+            yield format_sse(f"Lost connection to recommendation service: {e}", event="error")
+        except (ValueError, LookupError, TypeError, AttributeError) as e:
+            yield format_sse(f"Received an invalid response from recommendation service: {e}", event="error")
+        except Exception as e:
+            yield format_sse(f"An unexpected server error occurred: {e}", event="error")
         else:
-            # Log the full LLM response if it doesn't contain expected keys
-            print(f"WARNING: LLM response missing expected keys. Content: {llm_content}") # Use print for simple logging
-            raise HTTPException(
-                status_code=500, 
-                detail="Could not parse recommendation or insight from LLM response. LLM might have deviated from format."
-            )
+            yield format_sse({"recommendation": recommendation, "insight": insight}, event="done")
+
+    return StreamingResponse(relay(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.post("/get_recommendations", response_model=None)
+async def get_recommendations(request_data: BatchRecommendationRequest):
+    """
+    Handles a batch of recommendation requests.
+    Profiles that aren't cached are packed into as few Groq calls as possible
+    (up to MAX_PROFILES_PER_CALL each) and the results are returned in request order.
+    """
+    try:
+        profiles = [(item.dog_breed, item.diet_preference, item.product_type) for item in request_data.items]
+
+        results = {}
+        misses = []
+        for key in dict.fromkeys(profiles):
+            cached = RECOMMENDATION_CACHE.get(key)
+            if cached is not None:
+                RECOMMENDATION_CACHE.move_to_end(key)
+                results[key] = cached
+            else:
+                misses.append(key)
+
+        chunks = [misses[start:start + MAX_PROFILES_PER_CALL] for start in range(0, len(misses), MAX_PROFILES_PER_CALL)]
+        for chunk, chunk_results in zip(chunks, await call_groq_batches(chunks)):
+            for key, result in zip(chunk, chunk_results):
+                cache_recommendation(key, result)
+                results[key] = result
+
+        return ORJSONResponse({
+            "recommendations": [
+                {"recommendation": recommendation, "insight": insight}
+                for recommendation, insight in (results[key] for key in profiles)
+            ]
+        })
 
-    except requests.exceptions.RequestException as e:
+    except HTTPException:
+        raise
+    except httpx.HTTPError as e:
         print(f"ERROR: Error calling Groq API: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to connect to recommendation service: {e}")
-    except json.JSONDecodeError as e:
-        print(f"ERROR: Error parsing LLM JSON response: {e}, Raw Content: {llm_content}")
+    except orjson.JSONDecodeError as e:
+        print(f"ERROR: Error parsing LLM JSON response: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to process LLM response. Invalid JSON from LLM: {e}")
     except Exception as e:
         print(f"ERROR: An unexpected error occurred: {e}")
@@ -138,5 +765,20 @@ async def get_recommendation(request_data: RecommendationRequest):
 if __name__ == '__main__':
     # Get port from environment, default to 8000 for local development (FastAPI standard)
     port = int(os.environ.get("PORT", 8000))
-    # Run Uvicorn server
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Run one Uvicorn worker per CPU core by default, on uvloop with the httptools parser.
+    # Each worker is its own process with its own HTTP client, cache and semaphores.
+    workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+    # The workers re-import this module, so this is how they learn the worker count
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    # Run Uvicorn server (workers need the app as an import string)
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        limit_concurrency=1000,
+        timeout_keep_alive=30,
+        log_level="warning"
+    )